@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+""" Command-line benchmarks. Helpers shared by benchmark modules. """
+
+import os
+import time
+
+from django.conf import settings
+
+
+def configure_settings():
+    """ in-memory sqlite settings when run without django settings """
+    if not os.environ.get('DJANGO_SETTINGS_MODULE') \
+       and not settings.configured:
+        settings.configure(DATABASES={'default': {'ENGINE': \
+                                            'django.db.backends.sqlite3', \
+                                                  'NAME': ':memory:'}})
+
+# benchmark modules import bolibana_reporting which needs settings
+configure_settings()
+
+
+def best_of(func, repeat):
+    """ best wall time of func() over repeat runs """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def int_list(value):
+    """ list of ints from a comma separated string """
+    return [int(num) for num in value.split(',')]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+""" ExcelForm parsing benchmark on generated workbooks
+
+    Writes .xls (xlwt) and .xlsx (openpyxl) fixtures with a configurable
+    number of fields, blank and invalid values then times read(),
+    map_field(), converters and is_valid() for each reader backend.
+
+    python -m bolibana_reporting.benchmarks.excel -f 50,300 -b 0.1 -i 0.05 """
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+try:
+    import xlwt
+except ImportError:
+    xlwt = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from bolibana_reporting.benchmarks import best_of, int_list
+from bolibana_reporting.excel import (ExcelForm, ExcelFormField, \
+                                      ExcelTypeConverter, coord_to_cell)
+
+CHOICES = ['oui', 'non', 'nsp']
+
+
+def field_coord(index, nb_columns):
+    """ Excel coordinates of the index-th field in a grid of nb_columns """
+    column = index % nb_columns
+    letters = u""
+    column += 1
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return u"%s%d" % (letters, index // nb_columns + 1)
+
+
+def make_form(nb_fields, nb_columns=30):
+    """ ExcelForm sub-class with nb_fields int, choice and text fields """
+    mapping = {}
+    for index in range(nb_fields):
+        coord = field_coord(index, nb_columns)
+        kind = index % 3
+        if kind == 0:
+            field = ExcelFormField(coord, int, u"Int %d" % index)
+        elif kind == 1:
+            field = ExcelFormField(coord, ExcelTypeConverter.LowerChoiceList, \
+                                   u"Choice %d" % index, cast_args=CHOICES)
+        else:
+            field = ExcelFormField(coord, ExcelTypeConverter.clean, \
+                                   u"Text %d" % index)
+        mapping['field_%04d' % index] = field
+
+    attrs = {'_mapping': {'bench': mapping}, \
+             'is_complete': lambda self, *a, **k: True, \
+             'validate': lambda self, *a, **k: None}
+    return type('BenchmarkForm%d' % nb_fields, (ExcelForm,), attrs)
+
+
+def fixture_values(form_cls, blank_rate=0.0, invalid_rate=0.0, seed=0):
+    """ list of ((row, column), value) to write. None is a blank cell """
+    rand = random.Random(seed)
+    values = []
+    for variable, field in sorted(form_cls._mapping['bench'].items()):
+        draw = rand.random()
+        if draw < blank_rate:
+            value = None
+        elif draw < blank_rate + invalid_rate:
+            value = u"invalid"
+        elif field.type is int:
+            value = rand.randint(0, 1000)
+        elif field.cast_args:
+            value = rand.choice(CHOICES).upper()
+        else:
+            value = u"text %d" % rand.randint(0, 1000)
+        values.append((coord_to_cell(field.coord), value))
+    return values
+
+
+def write_xls(path, values):
+    """ writes values to a .xls file """
+    book = xlwt.Workbook()
+    sheet = book.add_sheet('bench')
+    for (row, column), value in values:
+        if value is not None:
+            sheet.write(row, column, value)
+    book.save(path)
+
+
+def write_xlsx(path, values):
+    """ writes values to a .xlsx file """
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'bench'
+    for (row, column), value in values:
+        if value is not None:
+            sheet.cell(row=row + 1, column=column + 1, value=value)
+    book.save(path)
+
+
+def bench_form(form_cls, path, repeat=5):
+    """ dict of best timings for the parsing steps of a file """
+    form = form_cls(path)
+    fields = form.mapping().items()
+    raw_values = [(field, form.data_for_coord(field.coord)) \
+                  for variable, field in fields]
+
+    def read():
+        # read() reuses an opened book: measure opening the file too
+        form.book = None
+        form.read()
+
+    def map_fields():
+        for variable, field in fields:
+            form.map_field(field, variable)
+
+    def convert():
+        for field, value in raw_values:
+            try:
+                field.converter(value)
+            except ValueError:
+                pass
+
+    def convert_raw():
+        for field, value in raw_values:
+            try:
+                if field.cast_args:
+                    field.type(value, field.cast_args)
+                else:
+                    field.type(value)
+            except ValueError:
+                pass
+
+    def is_valid():
+        form.is_valid()
+
+    return {'read': best_of(read, repeat), \
+            'field': best_of(map_fields, repeat) / max(1, len(fields)), \
+            'convert': best_of(convert, repeat), \
+            'convert_raw': best_of(convert_raw, repeat), \
+            'is_valid': best_of(is_valid, repeat), \
+            'errors': form.errors.count()}
+
+
+def main(argv=None):
+    parser = OptionParser(usage=u"%prog [options]")
+    parser.add_option('-f', '--fields', default='50,300', \
+                      help=u"comma separated numbers of fields")
+    parser.add_option('-c', '--columns', default=30, type='int', \
+                      help=u"number of columns used by fields")
+    parser.add_option('-b', '--blank-rate', default=0.1, type='float', \
+                      help=u"ratio of blank fields")
+    parser.add_option('-i', '--invalid-rate', default=0.05, type='float', \
+                      help=u"ratio of invalid values")
+    parser.add_option('-n', '--repeat', default=5, type='int', \
+                      help=u"runs per measure (best is kept)")
+    parser.add_option('-k', '--keep', action='store_true', default=False, \
+                      help=u"keep generated fixtures and print their folder")
+    options, args = parser.parse_args(argv)
+
+    writers = []
+    if xlwt is not None:
+        writers.append(('xls', write_xls))
+    if openpyxl is not None:
+        writers.append(('xlsx', write_xlsx))
+    if not writers:
+        parser.error(u"xlwt or openpyxl is required to write fixtures")
+
+    folder = tempfile.mkdtemp(prefix='bench_excel')
+    steps = ('read', 'field', 'convert', 'convert_raw', 'is_valid')
+    print(u"%6s %6s " % ('format', 'fields') \
+          + u" ".join([u"%11s" % step for step in steps]) \
+          + u" %6s" % 'errors')
+    try:
+        for nb_fields in int_list(options.fields):
+            form_cls = make_form(nb_fields, options.columns)
+            values = fixture_values(form_cls, options.blank_rate, \
+                                    options.invalid_rate)
+            for ext, writer in writers:
+                path = os.path.join(folder, 'form_%d.%s' % (nb_fields, ext))
+                writer(path, values)
+                results = bench_form(form_cls, path, options.repeat)
+                print(u"%6s %6d " % (ext, nb_fields) \
+                      + u" ".join([u"%11.6f" % results[step] \
+                                   for step in steps]) \
+                      + u" %6d" % results['errors'])
+    finally:
+        if options.keep:
+            print(folder)
+        else:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+""" IndicatorTable rendering benchmark on synthetic tables
+
+    Tables and periods are generated: no database is required.
+
+    python -m bolibana_reporting.benchmarks.indicators -l 10,50 -p 12,24 """
+
+import sys
+import random
+from optparse import OptionParser
+
+from bolibana_reporting.benchmarks import best_of, int_list
+from bolibana_reporting.indicators import (IndicatorTable, indicator, \
+                                           reference, label)
+
+
+class StubPeriod(object):
+    """ Period-like object with a pid. Not stored in database """
+
+    def __init__(self, num):
+        self.num = num
+        self.pid = '%02d%04d' % (num % 12 + 1, 2000 + num // 12)
+
+    def __repr__(self):
+        return '<StubPeriod %s>' % self.pid
+
+
+def stub_periods(nb_periods):
+    """ list of nb_periods StubPeriod """
+    return [StubPeriod(num) for num in range(nb_periods)]
+
+
+def make_indicator(index, ref_name, values, is_ref=False, is_batch=False):
+    """ indicator method returning values from a pid-indexed dict """
+    if is_batch:
+        def func(self, periods):
+            return dict([(period.pid, values[period.pid]) \
+                         for period in periods])
+    else:
+        def func(self, period):
+            return values[period.pid]
+
+    func = label(u"Line %d" % index)(func)
+    func = indicator(index, ref_name, batch=is_batch)(func)
+    if is_ref:
+        func = reference(func)
+    return func
+
+
+def make_table(nb_lines, nb_periods, nb_references=1, batch=False, seed=0):
+    """ IndicatorTable subclass with generated lines and values
+
+        The first nb_references lines are references and other lines
+        refer to them in turn. """
+    rand = random.Random(seed)
+    periods = stub_periods(nb_periods)
+    nb_references = max(1, min(nb_references, nb_lines))
+
+    attrs = {'name': u"Benchmark", \
+             'default_options': {'with_percentage': True, \
+                                 'with_total': True}}
+    for index in range(nb_lines):
+        is_ref = index < nb_references
+        ref_name = 'line_%03d' % (index % nb_references)
+        values = dict([(period.pid, rand.randint(0, 1000)) \
+                       for period in periods])
+        attrs['line_%03d' % index] = make_indicator(index, ref_name, \
+                                                    values, is_ref, batch)
+
+    table_cls = type('BenchmarkTable%dx%d' % (nb_lines, nb_periods), \
+                     (IndicatorTable,), attrs)
+    return table_cls, periods
+
+
+def bench_table(nb_lines, nb_periods, nb_references=1, \
+                batch=False, repeat=5):
+    """ dict of best timings for the rendering steps of a table """
+    table_cls, periods = make_table(nb_lines, nb_periods, \
+                                    nb_references, batch)
+    table = table_cls(None, periods)
+    lines = table.get_lines()
+    line = lines[-1]
+
+    def data():
+        table.data()
+
+    def line_data():
+        table.clear_cache()
+        table.get_line_data(line)
+
+    def percents():
+        table.clear_cache()
+        for aline in lines:
+            for period in periods:
+                table.get_indicator_rate(aline, period)
+
+    all_values = [[cell['value'] for cell in row['values'].values()] \
+                  for slug, row in table.data()]
+
+    def totals():
+        for values in all_values:
+            sum(table.clean_list(list(values)))
+
+    results = {'data': best_of(data, repeat), \
+               'line': best_of(line_data, repeat), \
+               'percents': best_of(percents, repeat), \
+               'totals': best_of(totals, repeat)}
+
+    try:
+        results['matrix'] = best_of(table.data_matrix, repeat)
+    except ImportError:
+        results['matrix'] = None
+    return results
+
+
+def main(argv=None):
+    parser = OptionParser(usage=u"%prog [options]")
+    parser.add_option('-l', '--lines', default='10,50', \
+                      help=u"comma separated numbers of lines")
+    parser.add_option('-p', '--periods', default='12,24', \
+                      help=u"comma separated numbers of periods")
+    parser.add_option('-r', '--references', default=1, type='int', \
+                      help=u"number of reference lines")
+    parser.add_option('-n', '--repeat', default=5, type='int', \
+                      help=u"runs per measure (best is kept)")
+    parser.add_option('-b', '--batch', action='store_true', default=False, \
+                      help=u"use batch indicators")
+    options, args = parser.parse_args(argv)
+
+    steps = ('data', 'line', 'percents', 'totals', 'matrix')
+    print(u"%8s %8s " % ('lines', 'periods') \
+          + u" ".join([u"%10s" % step for step in steps]))
+    for nb_lines in int_list(options.lines):
+        for nb_periods in int_list(options.periods):
+            results = bench_table(nb_lines, nb_periods, options.references, \
+                                  options.batch, options.repeat)
+            print(u"%8d %8d " % (nb_lines, nb_periods) \
+                  + u" ".join([u"%10s" % (u"%.5f" % results[step] \
+                                          if results[step] is not None \
+                                          else u"-") for step in steps]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+import hashlib
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+# a month. Entries are invalidated on Report save anyway.
+DEFAULT_TIMEOUT = 60 * 60 * 24 * 30
+# a day. Only repeated uploads are expected to hit it.
+DEFAULT_FORMS_TIMEOUT = 60 * 60 * 24
+
+
+def indicators_cache():
+    """ django cache backend storing indicator values
+
+        Uses the BOLIBANA_INDICATORS_CACHE alias from settings.CACHES
+        or the default one. """
+    return get_cache(getattr(settings, 'BOLIBANA_INDICATORS_CACHE', \
+                             'default'))
+
+
+def cache_timeout():
+    """ lifetime in seconds of cached indicator values """
+    return getattr(settings, 'BOLIBANA_INDICATORS_CACHE_TIMEOUT', \
+                   DEFAULT_TIMEOUT)
+
+
+def forms_cache():
+    """ django cache backend storing parsed Excel forms
+
+        Uses the BOLIBANA_FORMS_CACHE alias from settings.CACHES
+        or the default one. """
+    return get_cache(getattr(settings, 'BOLIBANA_FORMS_CACHE', 'default'))
+
+
+def forms_cache_timeout():
+    """ lifetime in seconds of parsed Excel forms """
+    return getattr(settings, 'BOLIBANA_FORMS_CACHE_TIMEOUT', \
+                   DEFAULT_FORMS_TIMEOUT)
+
+
+def period_pid(period):
+    """ pid of the typed period
+
+        Report.period is a base Period whose pid differs from
+        the pid of its proxy (MonthPeriod, ...) used by tables. """
+    if hasattr(period, 'typed'):
+        return period.typed().pid
+    return period.pid
+
+
+def generation_key(entity, period):
+    """ cache key of the generation token for an entity and a period """
+    return 'bolibana_reporting:generation:%s:%s' % (entity.slug, \
+                                                    period_pid(period))
+
+
+def generation(entity, period):
+    """ current generation token for an entity and a period
+
+        Cell keys include this token so that renewing it invalidates
+        all cached values for that entity and period at once. """
+    cache = indicators_cache()
+    key = generation_key(entity, period)
+    token = cache.get(key)
+    if token is None:
+        new_token = uuid4().hex
+        cache.add(key, new_token, cache_timeout())
+        # another process might have added one first
+        token = cache.get(key)
+        if token is None:
+            # dummy cache or evicted already: nothing is cached anyway
+            token = new_token
+    return token
+
+
+def cell_key(table_id, line, entity, period, fingerprint, token):
+    """ cache key of an indicator value """
+    raw = u":".join([table_id, line, entity.slug, period.pid, \
+                     fingerprint, token])
+    return 'bolibana_reporting:cell:%s' \
+           % hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def options_fingerprint(options, exclude=()):
+    """ stable hash of an options dict """
+    items = sorted([(key, value) for key, value in dict.items(options) \
+                    if not key in exclude])
+    return hashlib.md5(repr(items)).hexdigest()
+
+
+def invalidate_indicators(entity, period):
+    """ drops cached values of an entity, its ancestors and a period """
+    cache = indicators_cache()
+    for ent in entity.get_ancestors(include_self=True):
+        cache.set(generation_key(ent, period), uuid4().hex, cache_timeout())
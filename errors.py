@@ -13,6 +13,23 @@ class IncorrectReportData(Exception):
     pass
 
 
+class InvalidChoice(ValueError):
+    """ A value not included in a list of choices
+
+        Message is only formatted when displayed. """
+
+    def __init__(self, value, choices):
+        ValueError.__init__(self, value, choices)
+        self.value = value
+        self.choices = choices
+
+    def __unicode__(self):
+        return u"%s not in %s" % (self.value, self.choices)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
 class ErrorManager(object):
     """ An interface to a category-sorted dictionnary of errors """
 
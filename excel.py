@@ -4,16 +4,46 @@
 
 import os
 import re
+import mmap
+import hashlib
 import logging
+import zipfile
+from datetime import datetime, date, time, timedelta
+from cStringIO import StringIO
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 import xlrd
+try:
+    import openpyxl
+    from openpyxl.utils.datetime import to_excel
+except ImportError:
+    openpyxl = None
 from django.utils.translation import ugettext as _
 
 from bolibana_reporting.errors import (ErrorManager, MissingData, \
-                                       IncorrectReportData)
+                                       IncorrectReportData, InvalidChoice)
+from bolibana_reporting.utils import close_db_connections
+from bolibana_reporting.cache import forms_cache, forms_cache_timeout
 
 logger = logging.getLogger(__name__)
 
+COORD_RE = re.compile(r'^([a-zA-Z]+)([0-9]+)$')
+XLS_SIGNATURE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_SIGNATURE = 'PK\x03\x04'
+
+
+def coord_to_cell(coord):
+    """ zero-based (row, column) tuple from Excel coordinates (B4, AC12) """
+    match = COORD_RE.match(coord.strip())
+    if not match:
+        raise ValueError(u"%s is not a valid Excel coordinate" % coord)
+    letters, line = match.groups()
+    column = 0
+    for letter in letters.upper():
+        column = column * 26 + ord(letter) - ord('A') + 1
+    return (int(line) - 1, column - 1)
+
 
 class ExcelTypeConverter(object):
     """ module-like class offering different excel data to python mapping """
@@ -34,34 +64,281 @@ class ExcelTypeConverter(object):
         if value in choicelist:
             return value
         else:
-            raise ValueError(u"%s not in %s" % (value, choicelist))
+            raise InvalidChoice(value, choicelist)
 
     @classmethod
     def LowerChoiceList(cls, value, choicelist):
         """ cleaned value if it is included in provided list """
-        if cls.clean_str(value) in choicelist:
-            return cls.clean_str(value)
+        cleaned = cls.clean_str(value)
+        if cleaned in choicelist:
+            return cleaned
         else:
-            raise ValueError(u"%s not in %s" % (cls.clean_str(value), \
-                                                choicelist))
+            raise InvalidChoice(cleaned, choicelist)
 
     @classmethod
     def NormalizedChoiceList(cls, value, choicemap):
         """ mapped value of a cleaned index in a provided dict """
-        if cls.clean_str(value) in choicemap:
-            return choicemap[cls.clean_str(value)]
-        else:
-            raise ValueError(u"%s not in %s" % (cls.clean_str(value), \
-                                                choicemap.keys()))
+        cleaned = cls.clean_str(value)
+        try:
+            return choicemap[cleaned]
+        except KeyError:
+            raise InvalidChoice(cleaned, choicemap.keys())
 
     @classmethod
     def NormalizedIntChoiceList(cls, value, choicelist):
         """ int value if it is included in provided list of int """
-        if int(value) in choicelist:
+        ivalue = int(value)
+        if ivalue in choicelist:
+            return ivalue
+        else:
+            raise InvalidChoice(cls.clean_str(value), choicelist)
+
+    @classmethod
+    def compile(cls, converter, cast_args=None):
+        """ single-argument function equivalent to converter(value, args)
+
+            Choice converters get a set or dict of choices
+            for constant-time lookups. """
+        if not converter:
+            return lambda value: value
+        if not cast_args:
+            return converter
+
+        func = getattr(converter, 'im_func', None)
+        # sub-classes of the converter's class might override clean_str
+        clean = (getattr(converter, 'im_self', None) or cls).clean_str
+        try:
+            if func is cls.ChoiceList.im_func:
+                choices = frozenset(cast_args)
+
+                def convert(value):
+                    if value in choices:
+                        return value
+                    raise InvalidChoice(value, cast_args)
+                return convert
+
+            if func is cls.LowerChoiceList.im_func:
+                choices = frozenset(cast_args)
+
+                def convert(value):
+                    cleaned = clean(value)
+                    if cleaned in choices:
+                        return cleaned
+                    raise InvalidChoice(cleaned, cast_args)
+                return convert
+
+            if func is cls.NormalizedChoiceList.im_func:
+                choices = dict(cast_args)
+
+                def convert(value):
+                    cleaned = clean(value)
+                    try:
+                        return choices[cleaned]
+                    except KeyError:
+                        raise InvalidChoice(cleaned, cast_args.keys())
+                return convert
+
+            if func is cls.NormalizedIntChoiceList.im_func:
+                choices = frozenset(cast_args)
+
+                def convert(value):
+                    ivalue = int(value)
+                    if ivalue in choices:
+                        return ivalue
+                    raise InvalidChoice(clean(value), cast_args)
+                return convert
+        except TypeError:
+            # unhashable choices
+            pass
+
+        return lambda value: converter(value, cast_args)
+
+
+class XLSXSheet(object):
+    """ xlrd-like Sheet streaming values of a read-only openpyxl sheet
+
+        Only requested cells are kept in memory. Values have the types
+        xlrd returns: floats for numbers and dates, 1/0 for booleans. """
+
+    def __init__(self, worksheet, base_date):
+        self.worksheet = worksheet
+        self.name = worksheet.title
+        # workbook date system, for Excel serial dates
+        self.base_date = base_date
+        self.values = {}
+
+    def xlrd_value(self, value):
+        """ value of an openpyxl cell as xlrd would read it """
+        if value is None:
+            # xlrd returns an empty string for empty cells
+            return u""
+        if isinstance(value, bool):
             return int(value)
+        if isinstance(value, (int, long, float)):
+            return float(value)
+        if isinstance(value, (datetime, date, time, timedelta)):
+            return float(to_excel(value, self.base_date))
+        return value
+
+    def load(self, cells):
+        """ reads the values of (row, column) cells in a single pass """
+        cells = set(cells) - set(self.values.keys())
+        if not cells:
+            return
+        max_row = max([row for row, column in cells])
+        max_column = max([column for row, column in cells])
+        rows = self.worksheet.iter_rows(min_row=1, max_row=max_row + 1, \
+                                        min_col=1, max_col=max_column + 1)
+        for row, cells_row in enumerate(rows):
+            for column, cell in enumerate(cells_row):
+                if (row, column) in cells:
+                    self.values[(row, column)] = self.xlrd_value(cell.value)
+        # cells past the end of the sheet are empty: don't stream again
+        for cell in cells:
+            self.values.setdefault(cell, u"")
+
+    def cell_value(self, row, column):
+        """ value of the cell at zero-based row and column indexes """
+        if not (row, column) in self.values:
+            self.load([(row, column)])
+        return self.values[(row, column)]
+
+
+class XLSXBook(object):
+    """ xlrd-like Book reading .xlsx files in read-only mode """
+
+    def __init__(self, filepath):
+        """ filepath can also be a file-like object """
+        self.workbook = openpyxl.load_workbook(filepath, read_only=True, \
+                                               data_only=True)
+
+    def sheet_names(self):
+        return self.workbook.sheetnames
+
+    def sheet_by_name(self, name):
+        return XLSXSheet(self.workbook[name], self.workbook.excel_base_date)
+
+    def sheet_by_index(self, index):
+        return XLSXSheet(self.workbook.worksheets[index], \
+                         self.workbook.excel_base_date)
+
+    def release_resources(self):
+        """ closes the underlying file """
+        self.workbook.close()
+
+
+class MmapFile(object):
+    """ read-only file-like object over a mmap. Reads are not buffered """
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            end = len(self.mapped)
+        else:
+            end = min(len(self.mapped), self.position + size)
+        data = self.mapped[self.position:end]
+        self.position = max(self.position, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.mapped)
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+
+def is_file_contents(source):
+    """ whether source is the content of an Excel file and not a path """
+    if isinstance(source, (bytearray, mmap.mmap)):
+        return True
+    if isinstance(source, str):
+        return source.startswith(XLS_SIGNATURE) \
+            or source.startswith(ZIP_SIGNATURE)
+    return False
+
+
+def source_name(source):
+    """ printable name of an Excel source (path or buffer type) """
+    if isinstance(source, basestring) and not is_file_contents(source):
+        return source
+    return u"<%s>" % source.__class__.__name__
+
+
+def is_seekable(fileobj):
+    """ whether a file-like object can be rewound """
+    seekable = getattr(fileobj, 'seekable', None)
+    if seekable is not None:
+        return seekable()
+    return hasattr(fileobj, 'seek')
+
+
+def source_digest(source):
+    """ SHA-1 hex digest of the content of an Excel source """
+    digest = hashlib.sha1()
+    if is_file_contents(source):
+        digest.update(source[:])
+        return digest.hexdigest()
+
+    if hasattr(source, 'read'):
+        fileobj = source
+        if is_seekable(fileobj):
+            fileobj.seek(0)
+    else:
+        fileobj = open(source, 'rb')
+    try:
+        for chunk in iter(lambda: fileobj.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        if fileobj is source:
+            if is_seekable(fileobj):
+                fileobj.seek(0)
+        else:
+            fileobj.close()
+    return digest.hexdigest()
+
+
+def open_book(source):
+    """ Book loading its sheets only when requested
+
+        source can be a file path, the file content (str, bytearray
+        or mmap) or a file-like object such as an uploaded file.
+        .xlsx files are streamed by openpyxl if available,
+        other files are read by xlrd.
+        Can be shared by several ExcelForm using the book argument.
+        Only .xls files are loaded in memory (xlrd needs the content). """
+    if hasattr(source, 'read') and not isinstance(source, mmap.mmap):
+        if not is_seekable(source):
+            # can't stream twice from non-seekable files
+            source = source.read()
         else:
-            raise ValueError(u"%s not in %s" % (cls.clean_str(value), \
-                                                choicelist))
+            source.seek(0)
+            signature = source.read(len(ZIP_SIGNATURE))
+            source.seek(0)
+            if openpyxl is not None and signature == ZIP_SIGNATURE:
+                return XLSXBook(source)
+            return xlrd.open_workbook(file_contents=source.read(), \
+                                      on_demand=True)
+
+    if not is_file_contents(source):
+        if openpyxl is not None and zipfile.is_zipfile(source):
+            return XLSXBook(source)
+        return xlrd.open_workbook(source, on_demand=True)
+
+    if isinstance(source, bytearray):
+        source = str(source)
+    if openpyxl is not None and source[:4] == ZIP_SIGNATURE:
+        # zipfile needs a file-like object. Neither wrapper copies source
+        if isinstance(source, mmap.mmap):
+            return XLSXBook(MmapFile(source))
+        return XLSXBook(StringIO(source))
+    return xlrd.open_workbook(file_contents=source, on_demand=True)
 
 
 class ExcelFormField(object):
@@ -76,6 +353,15 @@ class ExcelFormField(object):
         self.cast_args = cast_args
         self.args = args
         self.kwargs = kwargs
+        self._converter = None
+
+    @property
+    def converter(self):
+        """ compiled single-argument version of type and cast_args """
+        if self._converter is None:
+            self._converter = ExcelTypeConverter.compile(self.type, \
+                                                         self.cast_args)
+        return self._converter
 
     def display_name(self):
         """ name of the field """
@@ -85,52 +371,96 @@ class ExcelFormField(object):
 
     def convert_data(self, value):
         """ converted data from type property """
-        if not self.type:
-            return value
-        if self.cast_args:
-            return self.type(value, self.cast_args)
-        else:
-            return self.type(value)
+        return self.converter(value)
 
 
 class ExcelForm(object):
 
-    """ A Form in an Excel File """
+    """ A Form in an Excel File
+
+        ARGUMENTS:
+            - filepath: path, content (str, bytearray or mmap) or
+              file-like object (uploaded file) of the Excel file
+            - sheet: name or index of the sheet (default to first one)
+            - version: key of the mapping to use
+            - book: already opened xlrd Book (see open_book()).
+              filepath is not read if provided.
+            - use_cache: reuse data and errors of a previous read of
+              the same content (see cache_key()). Defaults to
+              the use_cache class attribute. """
 
     _mapping = {None: {}}
     version = None
-    data = {}
+    use_cache = False
 
-    def __init__(self, filepath, sheet=None, version=None):
+    def __init__(self, filepath=None, sheet=None, version=None, book=None, \
+                 use_cache=None):
 
+        # data and errors belong to the instance so that forms
+        # can be parsed concurrently.
+        self.data = {}
         self.errors = ErrorManager()
 
         if version:
             self.version = version
+        if use_cache is not None:
+            self.use_cache = use_cache
 
         self.filepath = filepath
         self.sheet = sheet
+        self.book = book
+        # opened on demand after a cache hit (see data_for_cell())
+        self.ws = None
         self.read()
 
+    def cache_key(self, sheet=None):
+        """ forms cache key from content, form class, version and sheet """
+        parts = [source_digest(self.filepath), self.__class__.__module__, \
+                 self.__class__.__name__, unicode(self.mapping_version()), \
+                 unicode(sheet)]
+        return 'bolibana_reporting:form:%s' \
+               % hashlib.md5(u":".join(parts).encode('utf-8')).hexdigest()
+
     def read(self, sheet=None):
         """ parses all fields in mapping and stores converted data """
         if not sheet:
             sheet = self.sheet
 
         # one can re-call read() at any time
+        self.data = {}
         self.errors.reset()
+        self.ws = None
+        self.read_sheet = sheet
+
+        # previously parsed content
+        cache_key = None
+        if self.use_cache and self.book is None:
+            if hasattr(self.filepath, 'read') \
+               and not is_seekable(self.filepath):
+                # hashing would consume the stream: keep its content
+                self.filepath = self.filepath.read()
+            try:
+                cache_key = self.cache_key(sheet)
+            except Exception as e:
+                logger.warning(u"Unable to hash Excel file %(path)s. " \
+                               "Raised %(e)r" \
+                               % {'path': source_name(self.filepath), 'e': e})
+            else:
+                cached = forms_cache().get(cache_key)
+                if cached is not None:
+                    for variable, value in cached['data'].items():
+                        self.set(variable, value)
+                    for section, errors in cached['errors'].items():
+                        for error in errors:
+                            self.errors.add(error, section)
+                    return
 
         try:
-            book = xlrd.open_workbook(self.filepath)
-            if isinstance(sheet, basestring):
-                self.ws = book.sheet_by_name(sheet)
-            elif isinstance(sheet, int):
-                self.ws = book.sheets()[sheet]
-            else:
-                self.ws = book.sheets()[0]
+            self.ws = self.open_sheet(sheet)
         except Exception as e:
             logger.warning(u"Unable to read Excel Uploaded file %(path)s. " \
-                           "Raised %(e)r" % {'path': self.filepath, 'e': e})
+                           "Raised %(e)r" \
+                           % {'path': source_name(self.filepath), 'e': e})
             self.errors.add(u"Impossible d'ouvrir le masque de saisie. " \
                             u"Le fichier est corrompu ou a été modifié.")
             return
@@ -138,20 +468,66 @@ class ExcelForm(object):
         for fieldid, field in self.mapping().items():
             self.map_field(field, fieldid)
 
-    def mapping(self):
-        """ dict mapping of the current version """
+        if cache_key is not None:
+            data = self.to_dict()
+            forms_cache().set(cache_key, \
+                              {'data': dict([(variable, data[variable]) \
+                                             for variable in self.mapping() \
+                                             if variable in data]), \
+                               'errors': self.errors.all(by_section=True)}, \
+                              forms_cache_timeout())
+
+    def open_sheet(self, sheet=None):
+        """ sheet of the workbook by name, index or the first one """
+        # workbook is opened once and reused on re-reads
+        if self.book is None:
+            self.book = open_book(self.filepath)
+        if isinstance(sheet, basestring):
+            ws = self.book.sheet_by_name(sheet)
+        elif isinstance(sheet, int):
+            ws = self.book.sheet_by_index(sheet)
+        else:
+            ws = self.book.sheet_by_index(0)
+        # streamed sheets read all mapped cells at once
+        if isinstance(ws, XLSXSheet):
+            ws.load(self.cells(self.mapping_version()).values())
+        return ws
+
+    def mapping_version(self):
+        """ key of the current version in _mapping """
         if self.version:
-            return self._mapping[version]
+            return self.version
         else:
-            return self._mapping[self._mapping.keys()[0]]
+            return self._mapping.keys()[0]
+
+    def mapping(self):
+        """ dict mapping of the current version """
+        return self._mapping[self.mapping_version()]
+
+    @classmethod
+    def cells(cls, version):
+        """ (row, column) of each field of a mapping version
+
+            Coordinates are parsed once per class and version. """
+        # don't share parent's cells with sub-classes
+        if not '_cells' in cls.__dict__:
+            cls._cells = {}
+        if not version in cls._cells:
+            mapping = cls._mapping[version]
+            cls._cells[version] = dict([(fieldid, coord_to_cell(field.coord)) \
+                                        for fieldid, field in mapping.items()])
+        return cls._cells[version]
 
     def data_for_coord(self, coord):
         """ raw data from Excel coordinates """
-        XLS_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        letter, line = re.match(r'([a-zA-Z]+)([0-9]+)', coord).groups()
-        row = int(line) - 1
-        column = XLS_LETTERS.index(letter.upper())
-        return self.ws.row_values(row)[column]
+        return self.data_for_cell(*coord_to_cell(coord))
+
+    def data_for_cell(self, row, column):
+        """ raw data from zero-based row and column indexes """
+        if self.ws is None:
+            # read() found the data in cache without opening the file
+            self.ws = self.open_sheet(self.read_sheet)
+        return self.ws.cell_value(row, column)
 
     def field_name(self, variable):
         """ name of field from slug """
@@ -173,9 +549,13 @@ class ExcelForm(object):
     def map_field(self, field, variable):
         """ retrieve and store data from excel to mapping for field+slug """
         # raw data
-        fdata = self.data_for_coord(field.coord)
+        cells = self.cells(self.mapping_version())
+        if variable in cells:
+            fdata = self.data_for_cell(*cells[variable])
+        else:
+            fdata = self.data_for_coord(field.coord)
         try:
-            self.set(variable, field.convert_data(fdata))
+            self.set(variable, field.converter(fdata))
         except ValueError as e:
             # field is blank
             if ExcelTypeConverter.clean_str(fdata).__len__() == 0:
@@ -204,3 +584,84 @@ class ExcelForm(object):
     def to_dict(self):
         """ raw dict of all data """
         return self.data
+
+
+def _import_form(args):
+    """ parsed data and errors of a file. Run inside pool workers """
+    form_cls, source, sheet, version = args
+    try:
+        form = form_cls(source, sheet=sheet, version=version)
+        valid = form.is_valid()
+        return {'data': dict(form.to_dict()), \
+                'errors': form.errors.all(by_section=True), \
+                'valid': valid}
+    except Exception as e:
+        logger.warning(u"Unable to import Excel file %(path)s. " \
+                       "Raised %(e)r" % {'path': source_name(source), 'e': e})
+        return {'data': {}, 'valid': False, \
+                'errors': {'default': [u"Impossible d'importer le fichier."]}}
+    finally:
+        close_db_connections()
+
+
+def import_forms(form_cls, sources, sheet=None, version=None, \
+                 workers=None, queue_size=None):
+    """ parses and validates many files on a pool of processes
+
+        ARGUMENTS:
+            - form_cls: ExcelForm sub-class (module-level)
+            - sources: list of file paths or file contents (str)
+            - workers: number of processes (default to number of CPUs)
+            - queue_size: max number of files pending in the pool
+              (default to twice the number of workers)
+
+        Returns a (results, errors) tuple: list of dicts (source, data,
+        errors, valid) in sources order and an ErrorManager with
+        errors of all files, sectioned by source.
+
+        The caller's database connections are closed before forking:
+        TransactionManagementError is raised if a managed transaction
+        has uncommitted changes. """
+    workers = workers or cpu_count()
+    queue_size = queue_size or 2 * workers
+
+    # forked processes must not share the parent's connections
+    close_db_connections(refuse_dirty=True)
+    pool = Pool(workers, initializer=close_db_connections)
+    # (source, AsyncResult) of files sent to the pool, oldest first
+    pending = deque()
+    results = []
+
+    def collect():
+        # raises if the task failed outside of _import_form
+        # (unpicklable form_cls or source for example)
+        source, async_result = pending.popleft()
+        result = async_result.get()
+        result['source'] = source
+        results.append(result)
+
+    try:
+        for source in sources:
+            # waits for the oldest file when the queue is full
+            if len(pending) >= queue_size:
+                collect()
+            pending.append((source, \
+                            pool.apply_async(_import_form, \
+                                             [(form_cls, source, \
+                                               sheet, version)])))
+        pool.close()
+        while pending:
+            collect()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    errors = ErrorManager()
+    for index, result in enumerate(results):
+        if is_file_contents(result['source']):
+            section = u"#%d" % index
+        else:
+            section = source_name(result['source'])
+        for error in sum(result['errors'].values(), []):
+            errors.add(error, section)
+    return (results, errors)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+import csv
+from numbers import Number
+from datetime import date, time
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from django.utils.translation import ugettext as _
+
+
+def cell_value(value):
+    """ value as is if writers support its type, unicode otherwise
+
+        Labels are often lazy translations (ugettext_lazy). """
+    if value is None or isinstance(value, (basestring, Number, date, time)):
+        return value
+    return unicode(value)
+
+
+def table_header(table):
+    """ list of column titles of an IndicatorTable """
+    with_values = not table.options.only_percent
+    with_percent = table.options.with_percentage or table.options.only_percent
+
+    def titles(name):
+        cols = []
+        if with_values:
+            cols.append(name)
+        if with_percent:
+            cols.append(_(u"%(name)s (%%)") % {'name': name})
+        return cols
+
+    header = [u""]
+    for period in table.periods:
+        header.extend(titles(period.name()))
+    if table.options.with_total:
+        header.extend(titles(_(u"Total")))
+    return [cell_value(title) for title in header]
+
+
+def table_rows(table):
+    """ generator of rows (lists) of an IndicatorTable, header first
+
+        Lines are computed one at a time (see IndicatorTable.iter_data) """
+    with_values = not table.options.only_percent
+    with_percent = table.options.with_percentage or table.options.only_percent
+
+    def cells(data):
+        cols = []
+        if with_values:
+            cols.append(data.get('value'))
+        if with_percent:
+            cols.append(data.get('percent'))
+        return cols
+
+    yield table_header(table)
+
+    for slug, line in table.iter_data():
+        row = [line['label']]
+        if not line['blank']:
+            for period in table.periods:
+                row.extend(cells(line['values'][period.pid]))
+            if table.options.with_total:
+                row.extend(cells(line['total']))
+        yield [cell_value(cell) for cell in row]
+
+
+def export_csv(table, fileobj, **kwargs):
+    """ writes an IndicatorTable to a file-like object as UTF-8 CSV
+
+        Extra keyword arguments are passed to csv.writer """
+    writer = csv.writer(fileobj, **kwargs)
+    for row in table_rows(table):
+        writer.writerow([u"" if cell is None \
+                              else unicode(cell).encode('utf-8') \
+                         for cell in row])
+
+
+def export_xlsx(table, fileobj, sheet_name=None):
+    """ writes an IndicatorTable to a path or file-like object as .xlsx
+
+        Uses openpyxl's write-only mode: rows are not kept in memory. """
+    if openpyxl is None:
+        raise ImportError(u"export_xlsx() requires openpyxl")
+
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet(title=(sheet_name or table.id)[:31])
+    for row in table_rows(table):
+        sheet.append(row)
+    book.save(fileobj)
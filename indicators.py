@@ -2,10 +2,25 @@
 # encoding=utf-8
 # maintainer: rgaudin
 
+import time
+import logging
 from functools import wraps
-from inspect import getmembers, ismethod
+from inspect import ismethod
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from bolibana_reporting.models.Options import Options
+from bolibana_reporting.utils import close_db_connections
+from bolibana_reporting.cache import (indicators_cache, cache_timeout, \
+                                      generation, cell_key, \
+                                      options_fingerprint)
+
+logger = logging.getLogger(__name__)
 
 
 def blank(func):
@@ -41,12 +56,16 @@ def label(label, is_sub=False):
     return outer_wrapper
 
 
-def indicator(index=0, reference=None):
-    """ indicator tagging as row with a reference row name """
+def indicator(index=0, reference=None, batch=False):
+    """ indicator tagging as row with a reference row name
+
+        batch indicators receive the list of periods to compute and
+        return a dict of values indexed by period pid. """
     def outer_wrapper(func, *args, **kwargs):
         func._is_indicator = True
         func._reference = reference
         func._index = index
+        func._is_batch = batch
 
         @wraps(func)
         def wrapper(self, *args, **kwargs):
@@ -60,19 +79,131 @@ class NoSourceData(Exception):
     pass
 
 
+class IndicatorProfiler(object):
+    """ records time, calls and exceptions of indicator methods
+
+        ARGUMENTS:
+            - hook: callable receiving (line, pid, duration, exception)
+              after each call. pid is None for batch calls. """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.reset()
+
+    def reset(self):
+        """ removes all records """
+        self.lines = {}
+
+    @classmethod
+    def new_stats(cls):
+        return {'time': 0.0, 'calls': 0, 'exceptions': {}}
+
+    @classmethod
+    def update_stats(cls, stats, duration, exception):
+        stats['time'] += duration
+        stats['calls'] += 1
+        if exception is not None:
+            ename = exception.__class__.__name__
+            stats['exceptions'][ename] = stats['exceptions'].get(ename, 0) + 1
+
+    def record(self, line, pid, duration, exception=None):
+        """ add a call to line and period statistics """
+        if not line in self.lines:
+            self.lines[line] = self.new_stats()
+            self.lines[line]['periods'] = {}
+        stats = self.lines[line]
+        self.update_stats(stats, duration, exception)
+
+        if not pid in stats['periods']:
+            stats['periods'][pid] = self.new_stats()
+        self.update_stats(stats['periods'][pid], duration, exception)
+
+        if self.hook:
+            self.hook(line, pid, duration, exception)
+
+    def call(self, line, pid, func, *args):
+        """ call func with args, recording its duration and exception """
+        exception = None
+        start = time.time()
+        try:
+            return func(*args)
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.record(line, pid, time.time() - start, exception)
+
+    def summary(self):
+        """ list of (line, stats) items, slowest first """
+        return sorted(self.lines.items(), \
+                      key=lambda item: item[1]['time'], reverse=True)
+
+
+def log_indicator_call(line, pid, duration, exception=None):
+    """ IndicatorProfiler hook sending calls to the module logger """
+    logger.debug(u"%(line)s/%(pid)s: %(duration).4fs%(exception)s" \
+                 % {'line': line, 'pid': pid, 'duration': duration, \
+                    'exception': u" (%r)" % exception if exception else u""})
+
+
+class IndicatorTableMeta(type):
+    """ builds the lines registry of an IndicatorTable class
+
+        Decorated methods are inspected once, when the class is created,
+        so that instances only do dict lookups. """
+
+    def __init__(cls, name, bases, attrs):
+        super(IndicatorTableMeta, cls).__init__(name, bases, attrs)
+
+        cls._lines = {}
+        references = []
+        for attr in dir(cls):
+            member = getattr(cls, attr, None)
+            if not ismethod(member):
+                continue
+            if hasattr(member, '_is_reference'):
+                references.append(attr)
+            if not hasattr(member, '_is_indicator'):
+                continue
+            cls._lines[attr] = Options(index=member._index, \
+                                       reference=member._reference, \
+                                       is_reference=hasattr(member, \
+                                                            '_is_reference'), \
+                                       is_blank=hasattr(member, '_is_blank'), \
+                                       is_batch=getattr(member, '_is_batch', \
+                                                        False), \
+                                       label=getattr(member, '_label', attr), \
+                                       is_sub=getattr(member, '_is_sub', \
+                                                      False))
+        cls._line_names = sorted(cls._lines.keys())
+        # display order, as sorted by data()
+        cls._line_order = sorted(cls._line_names, \
+                                 key=lambda line: '%s_%s' \
+                                                  % (cls._lines[line].index, \
+                                                     line))
+        # default reference line is the first one by name
+        cls._default_reference = sorted(references)[0] \
+                                 if references else None
+
+
 class IndicatorTable(object):
     """ Data Table descriptor
 
         ARGUMENTS:
             - entity: Entity object
-            - periods: list of Period objects """
+            - periods: list of Period objects
+            - profiler: optional IndicatorProfiler recording calls """
+
+    __metaclass__ = IndicatorTableMeta
 
     # options common to all subclasses
     # can be override.
     main_default_options = {'with_data': True, \
                             'with_total': False, \
                             'with_reference': True, \
-                            'only_percent': False}
+                            'only_percent': False, \
+                            'with_cache': True, \
+                            'with_persistent_cache': False}
 
     # sub-class level default options
     default_options = {}
@@ -85,6 +216,12 @@ class IndicatorTable(object):
     def __init__(self, entity, periods, *args, **kwargs):
         self.entity = entity
         self.periods = periods
+        self._values = {}
+        self._tokens = {}
+        # batch results of the current line when with_cache is off
+        self._batch_values = {}
+        self._data = None
+        self.profiler = kwargs.pop('profiler', None)
         self.setup(kwargs)
 
     @property
@@ -99,43 +236,136 @@ class IndicatorTable(object):
             2. default_options dict
             3. any keyword argument passed to constructor.
             Each pass overrides conflicting options """
-        opt = self.main_default_options
+        opt = self.main_default_options.copy()
         opt.update(self.default_options)
         opt.update(options)
         self.options = Options(**opt)
 
     def data_unsorted(self):
         """ builds the data dictionary. """
+        # values are cached for a single rendering only
+        self.clear_cache()
         _data = {}
         for line in self.get_lines():
             is_ref = self.line_is_ref(line)
             if (is_ref and self.options.with_reference) or not is_ref:
                 _data[self.line_index_slug(line)] = self.get_line_data(line)
+        # kept for update_periods()
+        self._data = _data
         return _data
 
     def data(self):
         """ access method: sorted data dictionary items """
         return sorted(self.data_unsorted().items())
 
+    def iter_data(self):
+        """ access method: generator of sorted data dictionary items
+
+            Lines are computed one at a time, as they are consumed. """
+        self.clear_cache()
+        for line in self._line_order:
+            is_ref = self.line_is_ref(line)
+            if (is_ref and self.options.with_reference) or not is_ref:
+                yield (self.line_index_slug(line), self.get_line_data(line))
+
+    def data_matrix(self):
+        """ access method: lines x periods numpy arrays
+
+            Returns an Options with:
+            - lines, labels: ordered line names and labels (rows)
+            - pids: ordered period pids (columns)
+            - valid: boolean array of valid periods
+            - values, percents: float arrays. NaN for missing data.
+            - totals, total_percents: float arrays if with_total. """
+        if numpy is None:
+            raise ImportError(u"data_matrix() requires numpy")
+
+        self.clear_cache()
+
+        lines = [line for line in self.get_lines() \
+                 if self.options.with_reference or not self.line_is_ref(line)]
+        lines.sort(key=self.line_index_slug)
+
+        valid = numpy.array([self.period_is_valid(period) \
+                             for period in self.periods], dtype=bool)
+
+        rows = {}
+
+        def row_for(name):
+            if not name in rows:
+                if self.line_is_blank(name):
+                    row = [None] * len(self.periods)
+                else:
+                    row = [self.get_indicator_data(name, period) \
+                           if is_valid else None \
+                           for period, is_valid in zip(self.periods, valid)]
+                rows[name] = numpy.array(row, dtype=float)
+            return rows[name]
+
+        nan_row = numpy.empty(len(self.periods))
+        nan_row.fill(numpy.nan)
+
+        values = numpy.array([row_for(line) for line in lines], \
+                             dtype=float).reshape(len(lines), \
+                                                  len(self.periods))
+        refs = numpy.array([row_for(self.get_refname_for(line)) \
+                            if self.get_refname_for(line) else nan_row \
+                            for line in lines], \
+                           dtype=float).reshape(values.shape)
+        self._batch_values = {}
+        is_own_ref = numpy.array([self.get_refname_for(line) == line \
+                                  for line in lines], dtype=bool)
+        is_blank = numpy.array([self.line_is_blank(line) \
+                                for line in lines], dtype=bool)
+
+        def rates(num, den):
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                result = num / den
+            # a zero reference gives a zero rate (as get_indicator_rate)
+            result[(den == 0) & ~numpy.isnan(num)] = 0
+            return result
+
+        percents = rates(values, refs)
+        percents[numpy.outer(is_own_ref, valid)] = 1
+        percents[is_blank, :] = numpy.nan
+
+        totals = total_percents = None
+        if self.options.with_total:
+            totals = numpy.nansum(values, axis=1)
+            ref_totals = numpy.nansum(refs, axis=1)
+            total_percents = rates(totals, ref_totals)
+            total_percents[is_own_ref] = 1
+            totals[is_blank] = numpy.nan
+            total_percents[is_blank] = numpy.nan
+
+        return Options(lines=lines, \
+                       labels=[self.get_line_label(line) for line in lines], \
+                       pids=[period.pid for period in self.periods], \
+                       valid=valid, values=values, percents=percents, \
+                       totals=totals, total_percents=total_percents)
+
     def line_is_ref(self, name):
         """ is the requested line a reference one ? """
-        return hasattr(getattr(self, name), '_is_reference')
+        return self._lines[name].is_reference
 
     def line_is_blank(self, name):
         """ is the requested line a blank one ? """
-        return hasattr(getattr(self, name), '_is_blank')
+        return self._lines[name].is_blank
+
+    def line_is_batch(self, name):
+        """ is the requested line computed for all periods at once ? """
+        return self._lines[name].is_batch
 
     def line_index_slug(self, name):
         """ sorting-safe index slug for a line """
         try:
-            return '%s_%s' % (getattr(self, name)._index, name)
-        except:
+            return '%s_%s' % (self._lines[name].index, name)
+        except KeyError:
             return name
 
     def get_lines(self):
         """ list of lines to process """
-        inspect_lambda = lambda x: ismethod(x) and hasattr(x, '_is_indicator')
-        return [m[0] for m in getmembers(self, inspect_lambda)]
+        return list(self._line_names)
 
     def period_is_valid(self, period):
         """ [to override] is the current Period valid in terms of data ? """
@@ -163,41 +393,132 @@ class IndicatorTable(object):
         if is_blank:
             return line_data
 
+        try:
+            line_data['values'] = self.get_line_values(name, self.periods)
+        finally:
+            self._batch_values = {}
+
+        # calculate total if required
+        if self.options.with_total:
+            line_data['total'] = \
+                {'value': sum(self.clean_list([l['value'] \
+                                    for l in line_data['values'].values()])), \
+                 'percent': 1}
+
+        return line_data
+
+    def get_line_values(self, name, periods):
+        """ period dicts (value, percent) of a line indexed by pid """
+
+        values = {}
+
+        # values stored in the persistent cache
+        cached = self.get_cached_cells(name, periods)
+        computed = {}
+
         # loop on periods (columns)
-        for period in self.periods:
+        for period in periods:
 
             # Periods might be invalid: no data for the period.
             # In that case, we'll just skip it.
             if not self.period_is_valid(period):
                 # default empty period dict
-                line_data['values'][period.pid] = {'value': None, \
-                                                   'percent': None}
+                values[period.pid] = {'value': None, 'percent': None}
+                continue
+
+            if period.pid in cached:
+                values[period.pid] = cached[period.pid]
                 continue
 
             # get the raw value for that period
-            line_data['values'][period.pid] = \
-                               {'value': self.get_indicator_data(name, period)}
+            values[period.pid] = {'value': self.get_indicator_data(name, \
+                                                                   period)}
 
             # calculate the percentage if required
             if self.options.with_percentage:
-                line_data['values'][period.pid]['percent'] = \
+                values[period.pid]['percent'] = \
                                           self.get_indicator_rate(name, period)
 
-        # calculate total if required
-        if self.options.with_total:
-            line_data['total'] = \
-                {'value': sum(self.clean_list([l['value'] \
-                                    for l in line_data['values'].values()])), \
-                 'percent': 1}
+            computed[period.pid] = values[period.pid]
 
-        return line_data
+        self.set_cached_cells(name, computed, periods)
+
+        return values
+
+    def update_periods(self, new_periods, drop=0):
+        """ appends new periods and removes the `drop` oldest ones
+
+            Only the cells of new periods are computed: the data of
+            the previous data_unsorted() call is updated in place,
+            including totals. Returns sorted items like data(). """
+        new_periods = list(new_periods)
+        dropped = self.periods[:drop]
+        self.periods = list(self.periods[drop:]) + new_periods
+
+        if self._data is None:
+            return self.data()
+
+        dropped_pids = [period.pid for period in dropped]
+        for key in self._values.keys():
+            if key[1] in dropped_pids:
+                del self._values[key]
+
+        for line in self.get_lines():
+            line_data = self._data.get(self.line_index_slug(line))
+            if line_data is None or line_data['blank']:
+                continue
+
+            removed = [line_data['values'].pop(pid)['value'] \
+                       for pid in dropped_pids if pid in line_data['values']]
+            added = self.get_line_values(line, new_periods)
+            self._batch_values = {}
+            line_data['values'].update(added)
+
+            if 'total' in line_data:
+                line_data['total']['value'] += \
+                    sum(self.clean_list([l['value'] \
+                                         for l in added.values()])) \
+                    - sum(self.clean_list(removed))
+
+        return sorted(self._data.items())
+
+    def cell_keys(self, name, periods):
+        """ persistent cache keys of a line indexed by period pid """
+        fingerprint = options_fingerprint(self.options, \
+                                          exclude=('with_cache', \
+                                                   'with_persistent_cache'))
+        keys = {}
+        for period in periods:
+            if not period.pid in self._tokens:
+                self._tokens[period.pid] = generation(self.entity, period)
+            keys[period.pid] = cell_key(self.id, name, self.entity, period, \
+                                        fingerprint, self._tokens[period.pid])
+        return keys
+
+    def get_cached_cells(self, name, periods):
+        """ period dicts of a line found in the persistent cache """
+        if not self.options.with_persistent_cache:
+            return {}
+        keys = self.cell_keys(name, periods)
+        found = indicators_cache().get_many(keys.values())
+        return dict([(pid, found[key]) for pid, key in keys.items() \
+                     if key in found])
+
+    def set_cached_cells(self, name, cells, periods):
+        """ store period dicts of a line in the persistent cache """
+        if not self.options.with_persistent_cache or not cells:
+            return
+        keys = self.cell_keys(name, periods)
+        indicators_cache().set_many(dict([(keys[pid], cell) \
+                                          for pid, cell in cells.items()]), \
+                                    cache_timeout())
 
     def get_line_label(self, name):
         """ Label (row/series name) for a line """
         try:
             # label is store as property of the function using @label
-            return getattr(self, name)._label
-        except:
+            return self._lines[name].label
+        except KeyError:
             return name
 
     @classmethod
@@ -210,20 +531,73 @@ class IndicatorTable(object):
                 break
         return alist
 
+    def clear_cache(self):
+        """ removes all cached (line, period) values """
+        self._values = {}
+        self._tokens = {}
+        self._batch_values = {}
+
     def get_indicator_data(self, name, period):
-        """ retrieve raw value for a line and a period """
-        # get a list of all methods matching criteria:
-        # indicator with correct name. There should be exactly one.
-        inspect_lambda = lambda x: ismethod(x) \
-                                and hasattr(x, '_is_indicator') \
-                                and x.__name__ == name
-        mms = getmembers(self, inspect_lambda)
+        """ retrieve raw value for a line and a period
+
+            Values are cached per (line, period) unless
+            the `with_cache` option is disabled. """
+        if not self.options.with_cache:
+            if self.line_is_batch(name):
+                # one call per line, kept until get_line_data() returns
+                if not name in self._batch_values:
+                    self._batch_values[name] = \
+                        self.compute_batch_data(name, self.periods)
+                return self._batch_values[name].get(period.pid)
+            return self.compute_indicator_data(name, period)
+
+        key = (name, period.pid)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        if self.line_is_batch(name):
+            # one call fills the cache for every missing period of the line
+            periods = [aperiod for aperiod in self.periods \
+                       if not (name, aperiod.pid) in self._values]
+            values = self.compute_batch_data(name, periods)
+            for aperiod in periods:
+                self._values[(name, aperiod.pid)] = values.get(aperiod.pid)
+            return values.get(period.pid)
+
+        value = self.compute_indicator_data(name, period)
+        self._values[key] = value
+        return value
+
+    def compute_indicator_data(self, name, period):
+        """ call the indicator method for a line and a period """
+        # only registered indicators can be called
+        if not name in self._lines:
+            raise ValueError(u"%s is not an indicator" % name)
         try:
             # call the actual function
-            return mms[0][1](period)
+            if self.profiler is None:
+                return getattr(self, name)(period)
+            return self.profiler.call(name, period.pid, \
+                                      getattr(self, name), period)
         except NoSourceData:
             return None
 
+    def compute_batch_data(self, name, periods):
+        """ call a batch indicator method for several periods at once
+
+            returns a dict of values indexed by period pid. """
+        if not name in self._lines:
+            raise ValueError(u"%s is not an indicator" % name)
+        try:
+            if self.profiler is None:
+                return getattr(self, name)(periods) or {}
+            return self.profiler.call(name, None, \
+                                      getattr(self, name), periods) or {}
+        except NoSourceData:
+            return {}
+
     def get_indicator_rate(self, name, period):
         """ calculate percentage value for a line and a period """
 
@@ -233,8 +607,7 @@ class IndicatorTable(object):
 
         # retrieve value of its reference
         ref = self.get_reference_value(name, period)
-        # calculate raw value (we should be smarter here otherwise
-        # we calculate it two times.
+        # raw value is usually cached from get_line_data()
         value = self.get_indicator_data(name, period)
 
         # return None if there is no data value
@@ -256,9 +629,45 @@ class IndicatorTable(object):
 
     def get_refname_for(self, name):
         """ name of reference line for a given one """
-        stref = getattr(self, name)._reference
+        stref = self._lines[name].reference
         if not stref:
-            inspect_lambda = lambda x: ismethod(x) \
-                                    and hasattr(x, '_is_reference')
-            stref = getmembers(self, inspect_lambda)[0][0]
+            stref = self._default_reference
         return stref
+
+
+def _render_entity(args):
+    """ (slug, data) of a table for an entity. Run inside pool workers """
+    table_cls, entity, periods, options = args
+    try:
+        return (entity.slug, table_cls(entity, periods, **options).data())
+    finally:
+        # connections opened by workers are never reused nor closed
+        # by django outside of the request/response cycle.
+        close_db_connections()
+
+
+def render_for_entities(table_cls, entities, periods, \
+                        workers=None, processes=False, **options):
+    """ data() of an IndicatorTable class for each entity, by entity slug
+
+        Tables are rendered on a pool of `workers` threads or,
+        if processes is True, processes (default to number of CPUs).
+        Extra keyword arguments are passed as table options.
+
+        With processes, the caller's database connections are closed
+        before forking: TransactionManagementError is raised if a
+        managed transaction has uncommitted changes. """
+    args = [(table_cls, entity, periods, options) for entity in entities]
+
+    if processes:
+        # forked processes must not share the parent's connections
+        close_db_connections(refuse_dirty=True)
+        pool = Pool(workers, initializer=close_db_connections)
+    else:
+        pool = ThreadPool(workers)
+
+    try:
+        return dict(pool.map(_render_entity, args))
+    finally:
+        pool.close()
+        pool.join()
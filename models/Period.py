@@ -2,12 +2,19 @@
 # encoding=utf-8
 # maintainer: rgaudin
 
+from bisect import bisect_right, insort
 from datetime import datetime, date, timedelta
+from threading import RLock
 
-from django.db import models
-from django.utils.translation import ugettext_lazy as _, ugettext
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, class_prepared
+from django.dispatch import receiver
+from django.utils.translation import (ugettext_lazy as _, ugettext, \
+                                      get_language)
 
 from bolibana_reporting.utils import week_from_weeknum, next_month
+from bolibana_reporting.periods import DayValue, MonthValue, YearValue
 
 
 class DayManager(models.Manager):
@@ -52,6 +59,88 @@ class CustomManager(models.Manager):
                                         .filter(period_type=Period.CUSTOM)
 
 
+class PeriodIndex(object):
+    ''' Process-local sorted index of periods boundaries by period type
+
+    Finds the period including a date with a bisect on start dates
+    instead of a database query. Enabled by settings.BOLIBANA_PERIOD_INDEX
+    and kept in sync by post_save/post_delete signals.
+    Rows of uncommitted transactions are never added: they would stay
+    in the index after a rollback. '''
+
+    def __init__(self):
+        self.lock = RLock()
+        self.reset()
+
+    def reset(self):
+        ''' forgets all loaded period types '''
+        with self.lock:
+            # period_type: sorted list of (start_on, end_on, id)
+            self.entries = {}
+
+    @classmethod
+    def enabled(cls):
+        return getattr(settings, 'BOLIBANA_PERIOD_INDEX', False)
+
+    @classmethod
+    def committed(cls):
+        ''' whether rows read or saved now are committed '''
+        using = Period.objects.db
+        return not (transaction.is_managed(using=using) \
+                    and transaction.is_dirty(using=using))
+
+    def load(self, period_type):
+        ''' sorted entries of a type, fetched from database once '''
+        with self.lock:
+            if period_type in self.entries:
+                return self.entries[period_type]
+            entries = list(Period.objects \
+                           .filter(period_type=period_type) \
+                           .order_by('start_on', 'end_on', 'id') \
+                           .values_list('start_on', 'end_on', 'id'))
+            if self.committed():
+                self.entries[period_type] = entries
+            return entries
+
+    def find(self, period_type, date_obj):
+        ''' (start_on, end_on, id) of a period including date_obj or None '''
+        entries = self.load(period_type)
+        with self.lock:
+            # last period starting before date_obj, then going backward
+            # in case of periods overlapping.
+            pos = bisect_right(entries, (date_obj, datetime.max, None))
+            for start_on, end_on, pid in reversed(entries[:pos]):
+                if end_on >= date_obj:
+                    return (start_on, end_on, pid)
+                if self.is_regular(period_type):
+                    break
+        return None
+
+    @classmethod
+    def is_regular(cls, period_type):
+        ''' periods of that type never overlap '''
+        return period_type != Period.CUSTOM
+
+    def add(self, period, created=False):
+        with self.lock:
+            if period.period_type in self.entries:
+                # boundaries of an existing period might have changed
+                if not created:
+                    self.remove(period)
+                # found later by find_by_date() once committed
+                if self.committed():
+                    insort(self.entries[period.period_type], \
+                           (period.start_on, period.end_on, period.id))
+
+    def remove(self, period):
+        with self.lock:
+            for period_type, entries in self.entries.items():
+                for entry in entries:
+                    if entry[2] == period.id:
+                        entries.remove(entry)
+                        break
+
+
 class Period(models.Model):
     ''' Represents a Period of time. Base class ; should not be used directly.
 
@@ -126,16 +215,39 @@ class Period(models.Model):
     def __unicode__(self):
         return self.name()
 
-    def name(self):
+    def typed(self):
+        ''' instance of the proxy class of period_type. No query. '''
+        cls = period_classes.get(self.period_type, Period)
+        if isinstance(self, cls):
+            return self
+        return cls(id=self.id, start_on=self.start_on, end_on=self.end_on, \
+                   period_type=self.period_type)
+
+    def cached_format(self, method):
+        ''' result of a format method of the typed period
+
+        Cached per language as names only depend on boundaries. '''
+        key = (get_language(), method, self.period_type, \
+               self.start_on, self.end_on)
         try:
-            cls = eval(u"%sPeriod" % self.period_type.title())
-            return cls.objects.get(id=self.id).name()
-        except:
-            # TRANSLATORS: Python date format for Generic .name()
-            return self.middle().strftime(ugettext('%c'))
+            return period_names[key]
+        except KeyError:
+            value = getattr(self.typed(), method)()
+            period_names[key] = value
+            return value
+
+    def name(self):
+        return self.cached_format('format_name')
 
     def full_name(self):
-        return self.name()
+        return self.cached_format('format_full_name')
+
+    def format_name(self):
+        # TRANSLATORS: Python date format for Generic .name()
+        return self.middle().strftime(ugettext('%c'))
+
+    def format_full_name(self):
+        return self.format_name()
 
     def next(self):
         ''' returns next period in time '''
@@ -179,7 +291,7 @@ class Period(models.Model):
         if not week and not month:
             # assume year search
             sy = datetime(year, 1, 1, 0, 0)
-            ey = sy.replace(year=year + 1) - timedelta(ONE_MICROSECOND)
+            ey = sy.replace(year=year + 1) - timedelta(cls.ONE_MICROSECOND)
             try:
                 period = cls.objects.filter(start_on__lte=sy, \
                                             end_on__gte=ey)[0]
@@ -211,9 +323,7 @@ class Period(models.Model):
             date_obj = datetime.fromtimestamp(float(date_obj.strftime('%s')))
 
         try:
-            period = [period for period in cls.objects.all() \
-                                        if period.start_on <= date_obj \
-                                        and period.end_on >= date_obj][0]
+            period = cls.find_by_date(date_obj)
         except IndexError:
             if dont_create:
                 raise
@@ -221,6 +331,77 @@ class Period(models.Model):
             period.save()
         return period
 
+    @classmethod
+    def find_by_date(cls, date_obj):
+        ''' existing period including date. Raises IndexError if none '''
+        # proxies are restricted to their type: use the index if enabled
+        if cls._meta.proxy and period_index.enabled():
+            entry = period_index.find(cls.type(), date_obj)
+            if entry:
+                start_on, end_on, pid = entry
+                period = cls(id=pid, start_on=start_on, end_on=end_on, \
+                             period_type=cls.type())
+                # as if loaded by a query
+                period._state.adding = False
+                period._state.db = cls.objects.db
+                return period
+        period = cls.objects.filter(start_on__lte=date_obj, \
+                                    end_on__gte=date_obj).order_by('id')[0]
+        if cls._meta.proxy and period_index.enabled():
+            # created by another process after the index was loaded
+            period_index.add(period)
+        return period
+
+    @classmethod
+    def find_create_range(cls, start, end):
+        ''' ordered list of periods from the one including start
+            to the one including end. Missing ones are created.
+
+        p = MonthPeriod.find_create_range(date(2007, 1, 1), date(2011, 12, 31))
+
+        Boundaries are computed without database access then all
+        existing periods are fetched at once and missing ones are
+        inserted in a single query. '''
+        if not cls._meta.proxy:
+            raise ValueError(u"find_create_range() requires a period type. " \
+                             u"Use MonthPeriod, DayPeriod, etc.")
+
+        if not isinstance(start, datetime):
+            start = datetime(start.year, start.month, start.day)
+        if not isinstance(end, datetime):
+            end = datetime(end.year, end.month, end.day)
+
+        boundaries = []
+        date_obj = start
+        while True:
+            start_on, end_on = cls.boundaries(date_obj)
+            boundaries.append((start_on, end_on))
+            if end_on >= end:
+                break
+            date_obj = end_on + timedelta(cls.ONE_MICROSECOND)
+
+        def fetch():
+            qs = cls.objects.filter(start_on__gte=boundaries[0][0], \
+                                    end_on__lte=boundaries[-1][1])
+            return dict([((period.start_on, period.end_on), period) \
+                         for period in qs])
+
+        existing = fetch()
+        missing = [Period(start_on=start_on, end_on=end_on, \
+                          period_type=cls.type()) \
+                   for start_on, end_on in boundaries \
+                   if not (start_on, end_on) in existing]
+        if missing:
+            # bulk_create does not send post_save nor set ids
+            # and can't be used on proxy models.
+            Period.objects.bulk_create(missing)
+            existing = fetch()
+            for period in missing:
+                period_index.add(existing[(period.start_on, period.end_on)], \
+                                 created=True)
+
+        return [existing[bounds] for bounds in boundaries]
+
     @classmethod
     def find_create_with(cls, start_on, end_on, period_type=None):
         ''' creates a period with defined start and end dates '''
@@ -250,10 +431,14 @@ class DayPeriod(Period):
     def type(cls):
         return cls.DAY
 
-    def name(self):
+    def format_name(self):
         # Translators: Python's date format for DayPeriod.name()
         return self.middle().strftime(ugettext('%x'))
 
+    def to_value(self):
+        ''' database-free DayValue of this period '''
+        return DayValue(self.start_on, self.end_on)
+
     @classmethod
     def delta(self):
         return 1
@@ -262,7 +447,7 @@ class DayPeriod(Period):
     def boundaries(cls, date_obj):
         start = date_obj.replace(hour=0, minute=0, \
                                  second=0, microsecond=0)
-        end = start + timedelta(cls.delta()) - timedelta(ONE_MICROSECOND)
+        end = start + timedelta(cls.delta()) - timedelta(cls.ONE_MICROSECOND)
         return (start, end)
 
 
@@ -284,16 +469,20 @@ class MonthPeriod(Period):
     def pid(self):
         return self.middle().strftime('%m%Y')
 
-    def name(self):
+    def format_name(self):
         # Translators: Python's date format for MonthPeriod.name()
         return ugettext(u"%(formatted_date)s") % \
                  {'formatted_date': self.middle().strftime(ugettext('%m %Y'))}
 
-    def full_name(self):
+    def format_full_name(self):
         # Translators: Python's date format for MonthPeriod.full_name()
         return ugettext(u"%(formatted_date)s") % \
                  {'formatted_date': self.middle().strftime(ugettext('%B %Y'))}
 
+    def to_value(self):
+        ''' database-free MonthValue of this period '''
+        return MonthValue(self.start_on, self.end_on)
+
     @classmethod
     def delta(self):
         return 28
@@ -323,17 +512,62 @@ class YearPeriod(Period):
     def type(cls):
         return cls.YEAR
 
-    def name(self):
+    def format_name(self):
         # Translators: Python's date format for YearPeriod.name()
         return self.middle().strftime(ugettext('%Y'))
 
+    def to_value(self):
+        ''' database-free YearValue of this period '''
+        return YearValue(self.start_on, self.end_on)
+
     @classmethod
     def delta(self):
         return 365
 
     @classmethod
     def boundaries(cls, date_obj):
-        start = date_obj.replace(month=0, day=0, hour=0, minute=0, \
+        start = date_obj.replace(month=1, day=1, hour=0, minute=0, \
                                  second=0, microsecond=0)
-        end = start + timedelta(cls.delta()) - timedelta(ONE_MICROSECOND)
+        end = start.replace(year=start.year + 1) \
+              - timedelta(cls.ONE_MICROSECOND)
         return (start, end)
+
+
+period_index = PeriodIndex()
+
+# proxy class of each period type, used by Period.typed()
+period_classes = {Period.DAY: DayPeriod, \
+                  Period.MONTH: MonthPeriod, \
+                  Period.YEAR: YearPeriod}
+
+# formatted names by (language, method, period_type, start_on, end_on)
+period_names = {}
+
+
+def post_save_period(sender, instance, **kwargs):
+    """ adds saved periods to the index """
+    period_index.add(instance, kwargs.get('created', False))
+
+
+def post_delete_period(sender, instance, **kwargs):
+    """ removes deleted periods from the index """
+    period_index.remove(instance)
+
+
+def connect_period_signals(period_cls):
+    """ keeps the index in sync with saves of a Period (sub-)class
+
+        Signals are sent with the saved class as sender: proxies
+        need their own receivers. """
+    post_save.connect(post_save_period, sender=period_cls)
+    post_delete.connect(post_delete_period, sender=period_cls)
+
+for period_cls in (Period, DayPeriod, MonthPeriod, YearPeriod):
+    connect_period_signals(period_cls)
+
+
+@receiver(class_prepared)
+def connect_period_subclass(sender, **kwargs):
+    """ connects Period sub-classes defined in other modules """
+    if issubclass(sender, Period):
+        connect_period_signals(sender)
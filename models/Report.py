@@ -4,13 +4,15 @@
 
 from django.dispatch import receiver
 from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, class_prepared
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _, ugettext
 import reversion
 
 from bolibana_auth.models import Provider
 from bolibana_reporting.models import Period
+from bolibana_reporting.cache import invalidate_indicators
+from bolibana_reporting.periods import PeriodValue
 
 
 class UnValidatedManager(models.Manager):
@@ -88,7 +90,11 @@ class Report(models.Model):
 
     @classmethod
     def create(cls, period, entity, author, *args, **kwargs):
-        """ create a blank report filling all non-required fields """
+        """ create a blank report filling all non-required fields
+
+            period can be a Period or a PeriodValue (stored if needed) """
+        if isinstance(period, PeriodValue):
+            period = period.to_period()
         report = cls(period=period, entity=entity, created_by=author, \
                      modified_by=author, _status=cls.STATUS_UNSAVED)
         for arg, value in kwargs.items():
@@ -142,3 +148,21 @@ def post_save_report(sender, instance, **kwargs):
     if instance.receipt == 'NO_RECEIPT':
         instance.receipt = sender.generate_receipt(instance)
         instance.save()
+
+
+def post_save_report_invalidate(sender, instance, **kwargs):
+    """ invalidates cached indicators of the report's entity and period """
+    invalidate_indicators(instance.entity, instance.period)
+
+
+@receiver(class_prepared)
+def connect_report_subclass(sender, **kwargs):
+    """ connects post_save_report_invalidate to concrete Report classes
+
+        Report is abstract: post_save is sent with the concrete class
+        as sender, never with Report. """
+    if issubclass(sender, Report) and not sender._meta.abstract:
+        post_save.connect(post_save_report_invalidate, sender=sender, \
+                          dispatch_uid='report_invalidate_%s_%s' \
+                                       % (sender._meta.app_label, \
+                                          sender._meta.object_name))
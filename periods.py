@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+''' In-memory period values, computed without database access.
+
+    m = MonthValue.from_date(date(2011, 3, 12))
+    m.pid, m.next(), m + 12, m.previous() < m
+    m.to_period()  # MonthPeriod row, created if needed '''
+
+from datetime import datetime, timedelta
+
+
+class PeriodValue(object):
+    ''' Base class of hashable, immutable period values.
+
+    Sub-classes define period_type, model() and shift(). '''
+
+    __slots__ = ('start_on', 'end_on')
+
+    period_type = None
+
+    def __init__(self, start_on, end_on):
+        object.__setattr__(self, 'start_on', start_on)
+        object.__setattr__(self, 'end_on', end_on)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(u"%s is immutable" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (self.__class__, (self.start_on, self.end_on))
+
+    @classmethod
+    def from_date(cls, date_obj):
+        ''' period value including date_obj (date or datetime) '''
+        if not isinstance(date_obj, datetime):
+            date_obj = datetime(date_obj.year, date_obj.month, date_obj.day)
+        return cls(*cls.boundaries(date_obj))
+
+    @classmethod
+    def boundaries(cls, date_obj):
+        ''' start and end datetimes of the period including date_obj '''
+        # Period.boundaries() is pure date arithmetic
+        return cls.model().boundaries(date_obj)
+
+    def shift(self, count):
+        ''' period value count periods after (or before) this one '''
+        raise NotImplementedError
+
+    @classmethod
+    def model(cls):
+        ''' Period proxy class of that type '''
+        raise NotImplementedError
+
+    def middle(self):
+        ''' datetime at half of the period duration '''
+        return self.start_on + ((self.end_on - self.start_on) / 2)
+
+    def unsaved(self):
+        ''' unsaved Period proxy of that value. No database access '''
+        return self.model()(start_on=self.start_on, end_on=self.end_on, \
+                            period_type=self.period_type)
+
+    @property
+    def pid(self):
+        ''' A locale safe identifier of the period (same as Period.pid) '''
+        return self.unsaved().pid
+
+    def name(self):
+        return self.unsaved().name()
+
+    def full_name(self):
+        return self.unsaved().full_name()
+
+    def __unicode__(self):
+        return self.name()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.pid)
+
+    def next(self):
+        ''' following period value '''
+        return self.shift(1)
+
+    def previous(self):
+        ''' preceding period value '''
+        return self.shift(-1)
+
+    def __add__(self, count):
+        return self.shift(count)
+
+    def __sub__(self, count):
+        return self.shift(-count)
+
+    def includes(self, date_obj):
+        ''' whether date_obj (date or datetime) is within the period '''
+        if not isinstance(date_obj, datetime):
+            date_obj = datetime(date_obj.year, date_obj.month, \
+                                date_obj.day, 12, 0)
+        return self.start_on <= date_obj <= self.end_on
+
+    def _key(self):
+        return (self.period_type, self.start_on, self.end_on)
+
+    def __eq__(self, other):
+        if not isinstance(other, PeriodValue):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def _check_comparable(self, other):
+        # python 2 would fall back to comparing type names
+        if not isinstance(other, PeriodValue):
+            raise TypeError(u"unorderable types: %s and %s" \
+                            % (self.__class__.__name__, \
+                               other.__class__.__name__))
+
+    def __lt__(self, other):
+        self._check_comparable(other)
+        return self._key() < other._key()
+
+    def __le__(self, other):
+        self._check_comparable(other)
+        return self._key() <= other._key()
+
+    def __gt__(self, other):
+        self._check_comparable(other)
+        return self._key() > other._key()
+
+    def __ge__(self, other):
+        self._check_comparable(other)
+        return self._key() >= other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def to_period(self):
+        ''' Period row of that value, created if it doesn't exist '''
+        return self.model().find_create_with(self.start_on, self.end_on)
+
+
+class DayValue(PeriodValue):
+
+    __slots__ = ()
+
+    period_type = 'day'
+
+    @classmethod
+    def model(cls):
+        from bolibana_reporting.models.Period import DayPeriod
+        return DayPeriod
+
+    def shift(self, count):
+        return self.from_date(self.start_on + timedelta(count))
+
+
+class MonthValue(PeriodValue):
+
+    __slots__ = ()
+
+    period_type = 'month'
+
+    @classmethod
+    def model(cls):
+        from bolibana_reporting.models.Period import MonthPeriod
+        return MonthPeriod
+
+    def shift(self, count):
+        year, month = divmod(self.start_on.year * 12 \
+                             + self.start_on.month - 1 + count, 12)
+        return self.from_date(datetime(year, month + 1, 1))
+
+
+class YearValue(PeriodValue):
+
+    __slots__ = ()
+
+    period_type = 'year'
+
+    @classmethod
+    def model(cls):
+        from bolibana_reporting.models.Period import YearPeriod
+        return YearPeriod
+
+    def shift(self, count):
+        return self.from_date(datetime(self.start_on.year + count, 1, 1))
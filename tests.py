@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# encoding=utf-8
+# maintainer: rgaudin
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from StringIO import StringIO
+from threading import Thread, Lock
+
+import xlrd
+from django.db import models
+from django.test import SimpleTestCase, TestCase
+from django.utils.unittest import skipIf
+from django.utils.translation import ugettext_lazy
+
+from bolibana_reporting.models import (Entity, EntityType, MonthPeriod, \
+                                       Report)
+from bolibana_reporting.indicators import (IndicatorTable, indicator, \
+                                           reference, label)
+from bolibana_reporting.export import export_csv, export_xlsx
+from bolibana_reporting.excel import (ExcelForm, ExcelFormField, \
+                                      ExcelTypeConverter, XLSXBook)
+from bolibana_reporting.validator import DataValidator
+from bolibana_reporting.benchmarks.excel import (xlwt, openpyxl, \
+                                                 write_xls, fixture_values)
+
+NB_FIELDS = 30
+NB_FILES = 8
+NB_FORMS = 400
+NB_THREADS = 8
+
+
+class StressValidator(DataValidator):
+    """ an error for each value above 500 """
+
+    def validate(self):
+        for slug in sorted(self.data.data):
+            value = self.get(slug)
+            if isinstance(value, int) and value > 500:
+                self.errors.add(u"%s is too high" % slug)
+
+
+class StressForm(ExcelForm):
+
+    # same version name as benchmark forms for fixture_values()
+    _mapping = {'bench': dict([('field_%02d' % index, \
+                                 ExcelFormField('A%d' % (index + 1), int, \
+                                                u"Field %d" % index)) \
+                                for index in range(NB_FIELDS)])}
+
+    def is_complete(self, *args, **kwargs):
+        return True
+
+    def validate(self, *args, **kwargs):
+        validator = StressValidator(self)
+        validator.validate()
+        for error in validator.errors.all():
+            self.errors.add(error)
+
+
+def parse(path):
+    """ data, errors and validity of a form """
+    form = StressForm(path)
+    valid = form.is_valid()
+    return (dict(form.data), sorted(form.errors.all()), valid)
+
+
+@skipIf(xlwt is None, u"xlwt is required to write fixtures")
+class ExcelFormConcurrencyTest(SimpleTestCase):
+    """ forms parsed and validated in parallel threads keep their state """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='bolibana_tests')
+        self.paths = []
+        for index in range(NB_FILES):
+            path = os.path.join(self.folder, 'form_%d.xls' % index)
+            write_xls(path, fixture_values(StressForm, blank_rate=0.1, \
+                                           invalid_rate=0.1, seed=index))
+            self.paths.append(path)
+        self.expected = [parse(path) for path in self.paths]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_threads(self):
+        results = []
+        failures = []
+        lock = Lock()
+
+        def worker(offset):
+            try:
+                for num in range(offset, NB_FORMS, NB_THREADS):
+                    result = parse(self.paths[num % NB_FILES])
+                    with lock:
+                        results.append((num, result))
+            except Exception as e:
+                with lock:
+                    failures.append(e)
+
+        threads = [Thread(target=worker, args=(offset,)) \
+                   for offset in range(NB_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(len(results), NB_FORMS)
+        for num, result in results:
+            self.assertEqual(result, self.expected[num % NB_FILES])
+
+    def test_instances(self):
+        first, second = [StressForm(path) for path in self.paths[:2]]
+        self.assertFalse(first.data is second.data)
+        self.assertFalse(first.errors is second.errors)
+        validators = [StressValidator(first), StressValidator(second)]
+        self.assertFalse(validators[0].errors is validators[1].errors)
+
+
+class CacheReport(Report):
+    """ concrete Report for cache invalidation tests """
+
+    class Meta:
+        app_label = 'bolibana_reporting'
+
+    value = models.IntegerField(default=0)
+
+
+class ReportTable(IndicatorTable):
+
+    @indicator(0)
+    @reference
+    def value(self, period):
+        return CacheReport.objects.get(entity=self.entity, \
+                                       period=period).value
+
+
+class PersistentCacheTest(TestCase):
+    """ cached indicator cells are recomputed when a report is saved """
+
+    def setUp(self):
+        entity_type = EntityType.objects.create(name=u"Type", slug='type')
+        self.entity = Entity.objects.create(name=u"Entity", slug='entity', \
+                                            type=entity_type)
+        self.period = MonthPeriod.find_create_by_date(datetime(2011, 3, 1))
+        # foreign keys are not checked before commit (never in TestCase)
+        self.report = CacheReport.objects.create( \
+                                    period=self.period, entity=self.entity, \
+                                    type=Report.TYPE_SOURCE, receipt='test', \
+                                    created_by_id=1, value=5)
+
+    def cell(self):
+        table = ReportTable(self.entity, [self.period], \
+                            with_persistent_cache=True)
+        return dict(table.data())['0_value']['values'][self.period.pid]
+
+    def test_report_save(self):
+        self.assertEqual(self.cell()['value'], 5)
+        # cached: not recomputed when data changes without a save
+        CacheReport.objects.filter(id=self.report.id).update(value=7)
+        self.assertEqual(self.cell()['value'], 5)
+
+        self.report = CacheReport.objects.get(id=self.report.id)
+        self.report.value = 99
+        self.report.save()
+        self.assertEqual(self.cell()['value'], 99)
+
+
+class BackendForm(ExcelForm):
+
+    _mapping = {'backend': dict( \
+        [('raw_%d' % index, ExcelFormField('A%d' % (index + 1), None, \
+                                           u"Raw %d" % index)) \
+         for index in range(6)] \
+        + [('clean_%d' % index, \
+            ExcelFormField('A%d' % (index + 1), ExcelTypeConverter.clean, \
+                           u"Clean %d" % index)) for index in range(6)])}
+
+
+@skipIf(openpyxl is None, u"openpyxl is required for .xlsx files")
+class XLSXBackendTest(SimpleTestCase):
+    """ .xlsx files read by openpyxl give the same data as with xlrd """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='bolibana_tests')
+        self.path = os.path.join(self.folder, 'backend.xlsx')
+        book = openpyxl.Workbook()
+        sheet = book.active
+        for row, value in enumerate([1234, True, datetime(2011, 3, 1), \
+                                     12.5, u"text", \
+                                     datetime(2011, 3, 1, 12, 30)]):
+            sheet.cell(row=row + 1, column=1, value=value)
+        book.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_same_data(self):
+        try:
+            xlrd_book = xlrd.open_workbook(self.path)
+        except xlrd.XLRDError:
+            self.skipTest(u"xlrd can't read .xlsx files")
+        with_xlrd = BackendForm(self.path, book=xlrd_book)
+        with_openpyxl = BackendForm(self.path)
+        self.assertTrue(isinstance(with_openpyxl.book, XLSXBook))
+        self.assertEqual(with_openpyxl.data, with_xlrd.data)
+        self.assertEqual(with_openpyxl.data['clean_0'], u"1234.0")
+        self.assertEqual(with_openpyxl.data['raw_1'], 1)
+        self.assertEqual(with_openpyxl.data['raw_2'], 40603.0)
+
+
+class LabelTable(IndicatorTable):
+
+    name = u"Labels"
+
+    @indicator(0)
+    @reference
+    @label(ugettext_lazy(u"Lazy label"))
+    def total(self, period):
+        return 10
+
+
+class ExportTest(TestCase):
+    """ tables with lazy labels are exported """
+
+    def setUp(self):
+        self.period = MonthPeriod.find_create_by_date(datetime(2011, 3, 1))
+        self.table = LabelTable(None, [self.period], with_total=True)
+
+    def test_csv(self):
+        output = StringIO()
+        export_csv(self.table, output)
+        self.assertTrue('Lazy label,10,10' in output.getvalue())
+
+    @skipIf(openpyxl is None, u"openpyxl is required for .xlsx files")
+    def test_xlsx(self):
+        output = StringIO()
+        export_xlsx(self.table, output)
+        output.seek(0)
+        sheet = openpyxl.load_workbook(output).worksheets[0]
+        self.assertEqual([cell.value for cell in list(sheet.rows)[1]], \
+                         [u"Lazy label", 10, 10])
@@ -2,6 +2,15 @@
 # encoding=utf-8
 # maintainer: rgaudin
 
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.db import connections, transaction
+
 
 def week_from_weeknum(year, weeknum, is_iso=False):
     """ datetime tuple of start/end of week from a week number (and year) """
@@ -36,3 +45,66 @@ def next_month(year, month):
         return (year, month + 1)
     else:
         return (year + 1, 1)
+
+
+def close_db_connections(refuse_dirty=False):
+    """ closes all database connections of the current thread/process
+
+        Uncommitted changes are lost. With refuse_dirty, raises
+        TransactionManagementError instead if a managed transaction
+        has pending changes. """
+    if refuse_dirty:
+        for conn in connections.all():
+            if transaction.is_managed(using=conn.alias) \
+               and transaction.is_dirty(using=conn.alias):
+                raise transaction.TransactionManagementError( \
+                    u"Commit or rollback the transaction on %s " \
+                    u"before forking worker processes." % conn.alias)
+    for conn in connections.all():
+        conn.close()
+
+
+# months per period for types bucketed on month boundaries
+MONTHS_PER_PERIOD = {'month': 1, 'quarter': 3, 'semester': 6, 'year': 12}
+
+
+def period_keys(dates, period_type):
+    """ numpy datetime64[D] array of the period start of each date
+
+        One vectorized pass over any array-like of dates (datetime64,
+        date, datetime or ISO strings). period_type is one of day, week,
+        month, quarter, semester or year. As in week_from_weeknum(),
+        weeks start on Monday except week 0 which starts on January 1st.
+        Missing dates (NaT) stay NaT. A single date gives a single key.
+        Bucket once, then look periods up per unique key:
+
+        keys = period_keys(dates, 'month')
+        starts, inverse = numpy.unique(keys, return_inverse=True) """
+    if numpy is None:
+        raise ImportError(u"period_keys() requires numpy")
+
+    days = numpy.asarray(dates, dtype='datetime64[D]')
+    is_scalar = days.ndim == 0
+    days = numpy.atleast_1d(days)
+
+    if period_type == 'day':
+        keys = days.copy()
+    elif period_type == 'week':
+        # 1970-01-01 (day 0) is a Thursday
+        day_nums = days.astype('int64')
+        mondays = (day_nums - (day_nums + 3) % 7).astype('datetime64[D]')
+        # week 0 doesn't start in the previous year
+        keys = numpy.maximum(mondays, days.astype('datetime64[Y]') \
+                                          .astype('datetime64[D]'))
+    elif period_type in MONTHS_PER_PERIOD:
+        months = days.astype('datetime64[M]').astype('int64')
+        months -= months % MONTHS_PER_PERIOD[period_type]
+        keys = months.astype('datetime64[M]').astype('datetime64[D]')
+    else:
+        raise ValueError(u"Unsupported period type: %s" % period_type)
+
+    # integer arithmetic turns NaT into a valid date
+    keys[numpy.isnat(days)] = numpy.datetime64('NaT')
+    if is_scalar:
+        return keys[0]
+    return keys
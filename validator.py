@@ -20,11 +20,10 @@ class Options(dict, object):
 class DataValidator(object):
     """ Interface for business-logic data validators """
 
-    errors = ErrorManager()
-
     def __init__(self, data_browser, **kwargs):
         self.data = data_browser
         self.options = Options(**kwargs)
+        self.errors = ErrorManager()
 
     def validate(self):
         pass